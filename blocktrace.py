@@ -0,0 +1,396 @@
+import csv
+from bisect import bisect_right
+from collections import defaultdict
+from struct import unpack_from
+
+_ATTR_DIRECTORY = 0x10
+_ATTR_LFN = 0x0F
+
+
+class FATReader:
+    """
+    Parses a FAT16 image.
+
+    Parameters
+    ----------
+    read
+        A function `read(offset, length)` reading the image.
+    """
+    def __init__(self, read):
+        self.read = read
+        boot = read(0, 512)
+        (ss, spc, reserved, n_fats, root_entries, total16, _, fat_sectors,
+         _, _, _, total32) = unpack_from("<HBHBHHBHHHII", boot, 11)
+        if fat_sectors == 0 or boot[510:512] != b"\x55\xAA":
+            raise ValueError("not a FAT16 image")
+        self.sector_size = ss
+        self.cluster_size = spc * ss
+        self.fat_start = reserved * ss
+        self.root_start = self.fat_start + n_fats * fat_sectors * ss
+        self.data_start = self.root_start + (root_entries * 32 + ss - 1) // ss * ss
+        self.size = (total16 or total32) * ss
+        self.fat = read(self.fat_start, fat_sectors * ss)
+
+    def chain(self, cluster: int) -> list[int]:
+        """Collects the cluster chain."""
+        result = []
+        while 2 <= cluster < 0xFFF7 and len(result) < len(self.fat) // 2:
+            result.append(cluster)
+            cluster, = unpack_from("<H", self.fat, 2 * cluster)
+        return result
+
+    def cluster_offset(self, cluster: int) -> int:
+        return self.data_start + (cluster - 2) * self.cluster_size
+
+    def read_chain(self, clusters: list[int]) -> bytes:
+        return b"".join(self.read(self.cluster_offset(i), self.cluster_size) for i in clusters)
+
+    def read_file(self, entry) -> bytes:
+        """Reads file contents."""
+        return self.read_chain(entry[3])[:entry[2]]
+
+    def _list(self, table: bytes):
+        lfn = {}
+        for i in range(0, len(table), 32):
+            record = table[i:i + 32]
+            if record[0] == 0:
+                break
+            attr = record[11]
+            if record[0] == 0xE5:
+                lfn = {}
+            elif attr == _ATTR_LFN:
+                if not lfn:
+                    first = i
+                lfn[record[0] & 0x1F] = record[1:11] + record[14:26] + record[28:32]
+            elif attr & 0x08:  # volume label
+                lfn = {}
+            else:
+                if lfn:
+                    name = b"".join(lfn[k] for k in sorted(lfn)).decode("utf-16-le").split("\x00")[0]
+                else:
+                    base, ext = record[:8].decode("latin-1").rstrip(), record[8:11].decode("latin-1").rstrip()
+                    if record[12] & 0x08:
+                        base = base.lower()
+                    if record[12] & 0x10:
+                        ext = ext.lower()
+                    name = f"{base}.{ext}" if ext else base
+                records = range(first if lfn else i, i + 32, 32)
+                lfn = {}
+                if name not in (".", ".."):
+                    cluster, size = unpack_from("<HI", record, 26)
+                    yield name, bool(attr & _ATTR_DIRECTORY), size, cluster, records
+
+    def walk(self, path: str = "/", clusters: list[int] = None, records: list[int] = None):
+        """
+        Walks the image.
+
+        Yields
+        ------
+        Tuples `(path, is_dir, size, clusters, records)` for
+        all files and folders including the root where
+        `records` are image offsets of 32-byte folder table
+        records describing the item (empty for the root).
+        """
+        if clusters is None:
+            table = self.read(self.root_start, self.data_start - self.root_start)
+            clusters = []
+
+            def _offset(i):
+                return self.root_start + i
+        else:
+            table = self.read_chain(clusters)
+
+            def _offset(i):
+                return self.cluster_offset(clusters[i // self.cluster_size]) + i % self.cluster_size
+        yield path, True, 0, clusters, records or []
+        for name, is_dir, size, cluster, child_records in self._list(table):
+            child = f"{path.rstrip('/')}/{name}"
+            child_records = [_offset(i) for i in child_records]
+            if is_dir:
+                yield from self.walk(child, self.chain(cluster), child_records)
+            else:
+                yield child, False, size, self.chain(cluster), child_records
+
+
+def _merge(blocks: dict[int, str], block_size: int) -> list[tuple[int, int, str]]:
+    """Merges consecutive blocks with the same label into byte ranges."""
+    result = []
+    for block in sorted(blocks):
+        start, end, label = block * block_size, (block + 1) * block_size, blocks[block]
+        if result and result[-1][1] == start and result[-1][2] == label:
+            result[-1] = (result[-1][0], end, label)
+        else:
+            result.append((start, end, label))
+    return result
+
+
+def fat_ranges(read) -> list[tuple[int, int, str]]:
+    """
+    Maps a FAT16 image into labelled byte ranges.
+
+    Parameters
+    ----------
+    read
+        A function `read(offset, length)` reading the image.
+
+    Returns
+    -------
+    A sorted list of `(start, end, label)` where label is
+    either a file path or a metadata label in angle brackets.
+    """
+    image = FATReader(read)
+    result = [
+        (0, image.fat_start, "<boot>"),
+        (image.fat_start, image.root_start, "<fat>"),
+        (image.root_start, image.data_start, "<dir />"),
+    ]
+    clusters = {}
+    for path, is_dir, size, chain, records in image.walk():
+        for i in chain:
+            clusters[i] = f"<dir {path}>" if is_dir else path
+    for start, end, label in _merge(clusters, image.cluster_size):
+        result.append((image.cluster_offset(start // image.cluster_size),
+                       image.cluster_offset(end // image.cluster_size), label))
+    return result
+
+
+def _open_lfs(read, size: int, block_size: int):
+    """Mounts a littlefs image and returns it with the set collecting numbers of blocks read."""
+    from littlefs import LittleFS, UserContext
+
+    class _Context(UserContext):
+        """Reads blocks on demand: the image is never copied as a whole."""
+        def __init__(self):
+            pass
+
+        def read(self, cfg, block, off, size):
+            accessed.add(block)
+            return bytearray(read(block * cfg.block_size + off, size))
+
+        def prog(self, cfg, block, off, data):
+            raise NotImplementedError("read-only image")
+
+        def erase(self, cfg, block):
+            raise NotImplementedError("read-only image")
+
+    accessed = set()
+    fs = LittleFS(context=_Context(), block_size=block_size,
+                  block_count=size // block_size, mount=False)
+    fs.mount()
+    return fs, accessed
+
+
+def lfs_ranges(read, size: int, block_size: int) -> list[tuple[int, int, str]]:
+    """
+    Maps a littlefs image into labelled byte ranges.
+
+    Blocks are attributed by observing which ones
+    littlefs reads while walking the image: blocks read
+    while listing a folder belong to the folder (including
+    inlined small files) and the rest read while reading
+    a file belong to the file. Remaining blocks read while
+    mounting are attributed to `<metadata>`.
+
+    Parameters
+    ----------
+    read
+        A function `read(offset, length)` reading the image.
+    size
+        Image size.
+    block_size
+        The size of the block.
+
+    Returns
+    -------
+    A sorted list of `(start, end, label)`.
+    """
+    fs, accessed = _open_lfs(read, size, block_size)
+    mount_blocks = set(accessed)
+    accessed.clear()
+    blocks = {}
+
+    def _collect(label):
+        for i in accessed:
+            blocks.setdefault(i, label)
+        accessed.clear()
+
+    folders = ["/"]
+    while folders:
+        folder = folders.pop()
+        items = list(fs.scandir(folder))
+        _collect(f"<dir {folder}>")
+        for item in items:
+            path = f"{folder.rstrip('/')}/{item.name}"
+            if item.type == 2:
+                folders.append(path)
+            else:
+                with fs.open(path, "rb") as f:
+                    f.read()
+                _collect(path)
+    accessed.update(mount_blocks)
+    _collect("<metadata>")
+    fs.unmount()
+    return _merge(blocks, block_size)
+
+
+def attribute(trace, ranges: list[tuple[int, int, str]]) -> dict[str, list]:
+    """
+    Attributes traced requests to labelled ranges.
+
+    Parameters
+    ----------
+    trace
+        Requests `(timestamp, duration, connection, command, offset, length)`
+        recorded by the server.
+    ranges
+        A sorted list of non-overlapping `(start, end, label)`.
+
+    Returns
+    -------
+    A dictionary `{label: [requests, bytes_read, bytes_written, time]}`
+    where request durations (time since the previous reply as seen
+    by the device) are split between labels in proportion to the
+    bytes served. Bytes outside ranges are attributed to `<free>`.
+    """
+    starts = [i[0] for i in ranges]
+    result = defaultdict(lambda: [0, 0, 0, 0.])
+    for timestamp, duration, connection, command, offset, length in trace:
+        if command not in (0, 1) or length == 0:
+            continue
+        shares = defaultdict(int)
+        pos, end = offset, offset + length
+        k = max(bisect_right(starts, offset) - 1, 0)
+        while pos < end:
+            if k < len(ranges) and ranges[k][1] <= pos:
+                k += 1
+                continue
+            if k < len(ranges) and ranges[k][0] <= pos:
+                chunk_end, label = min(ranges[k][1], end), ranges[k][2]
+            else:
+                chunk_end, label = min(ranges[k][0], end) if k < len(ranges) else end, "<free>"
+            shares[label] += chunk_end - pos
+            pos = chunk_end
+        for label, n in shares.items():
+            stats = result[label]
+            stats[0] += 1
+            stats[1 + command] += n
+            stats[3] += duration * n / length
+    return dict(result)
+
+
+def format_report(stats: dict[str, list]) -> str:
+    """Formats attributed statistics as a table sorted by time."""
+    lines = [f"{'time, s':>9} {'requests':>9} {'read':>10} {'written':>10}  item"]
+    for label, (n, n_read, n_written, t) in sorted(stats.items(), key=lambda i: (-i[1][3], i[0])):
+        lines.append(f"{t:9.3f} {n:9d} {n_read:10d} {n_written:10d}  {label}")
+    return "\n".join(lines) + "\n"
+
+
+def write_csv(trace, f):
+    """
+    Writes raw requests as CSV.
+
+    Parameters
+    ----------
+    trace
+        Requests `(timestamp, duration, connection, command, offset, length)`
+        recorded by the server.
+    f
+        A text file to write to.
+    """
+    commands = {0: "read", 1: "write", 2: "disconnect", 3: "flush"}
+    writer = csv.writer(f)
+    writer.writerow(["timestamp", "duration", "connection", "command", "offset", "length"])
+    for timestamp, duration, connection, command, offset, length in trace:
+        writer.writerow([f"{timestamp:.6f}", f"{duration:.6f}", connection,
+                         commands.get(command, command), offset, length])
+
+
+def image_ranges(image, fs: str, block_size: int) -> list[tuple[int, int, str]]:
+    """
+    Maps an image into labelled byte ranges.
+
+    Parameters
+    ----------
+    image
+        An object with `size` attribute and `read(offset, length)` method.
+    fs
+        File system: fat, vfat or lfs.
+    block_size
+        The size of the block.
+
+    Returns
+    -------
+    A sorted list of `(start, end, label)`.
+    """
+    if fs in ("fat", "vfat"):
+        return fat_ranges(image.read)
+    elif fs == "lfs":
+        return lfs_ranges(image.read, image.size, block_size)
+    raise ValueError(f"unknown {fs=}")
+
+
+def changed_files(image, fs: str, block_size: int, dirty: set[int]) -> dict[str, bytes]:
+    """
+    Extracts files possibly affected by writes.
+
+    Only metadata and the candidate files are read: FAT
+    files with dirty clusters or dirty folder table records
+    and littlefs files in folders with dirty metadata blocks
+    (any littlefs file update is committed to the folder).
+
+    Parameters
+    ----------
+    image
+        An object with `size` attribute and `read(offset, length)` method.
+    fs
+        File system: fat, vfat or lfs.
+    block_size
+        The size of the block.
+    dirty
+        Numbers of blocks written.
+
+    Returns
+    -------
+    A dictionary `{file_name: file_content}` where
+    affected folders have `None` content.
+    """
+    def _is_dirty(start, end):
+        return any(i in dirty for i in range(start // block_size, (end - 1) // block_size + 1))
+
+    result = {}
+    if fs in ("fat", "vfat"):
+        reader = FATReader(image.read)
+        for entry in reader.walk():
+            path, is_dir, size, chain, records = entry
+            ranges = [(i, i + 32) for i in records]
+            ranges.extend((reader.cluster_offset(i), reader.cluster_offset(i + 1)) for i in chain)
+            if is_dir and not chain:
+                ranges = [(reader.root_start, reader.data_start)]
+            if any(_is_dirty(*i) for i in ranges):
+                result[path] = None if is_dir else reader.read_file(entry)
+
+    elif fs == "lfs":
+        lfs, accessed = _open_lfs(image.read, image.size, block_size)
+        # folder lookups read metadata of parents as well
+        folders = [("/", set())]
+        while folders:
+            folder, parent_blocks = folders.pop()
+            accessed.clear()
+            items = list(lfs.scandir(folder))
+            blocks = set(accessed)
+            is_dirty = not dirty.isdisjoint(blocks - parent_blocks)
+            if is_dirty:
+                result[folder] = None
+            for item in items:
+                path = f"{folder.rstrip('/')}/{item.name}"
+                if item.type == 2:
+                    folders.append((path, blocks))
+                elif is_dirty:
+                    with lfs.open(path, "rb") as f:
+                        result[path] = f.read()
+        lfs.unmount()
+
+    else:
+        raise ValueError(f"unknown {fs=}")
+    return result
@@ -9,7 +9,10 @@ import subprocess
 import os
 import socket
 from contextlib import closing, contextmanager
-from time import sleep
+from time import sleep, time, perf_counter
+from struct import pack, unpack
+import socketserver
+import threading
 import logging
 import serial.tools.list_ports
 
@@ -48,6 +51,42 @@ def collect_path(src: str) -> (dict[str, bytes], int):
     return result, size
 
 
+def write_items(src: dict[str, bytes], dst: str) -> int:
+    """
+    Writes items into the specified location.
+    Files with the same content are not overwritten.
+    Raises a `ValueError` for items outside the location.
+
+    Parameters
+    ----------
+    src
+        A dictionary `{file_name: file_content}` where
+        folders have `None` content.
+    dst
+        Root folder to write to.
+
+    Returns
+    -------
+    The number of files written.
+    """
+    dst = Path(dst).resolve()
+    targets = {}
+    for name in src:
+        targets[name] = item = (dst / name.lstrip("/")).resolve()
+        if item != dst and dst not in item.parents:
+            raise ValueError(f"item outside {dst}: {name}")
+    result = 0
+    for name, content in src.items():
+        item = targets[name]
+        if content is None:
+            item.mkdir(parents=True, exist_ok=True)
+        elif not item.is_file() or item.stat().st_size != len(content) or item.read_bytes() != content:
+            item.parent.mkdir(parents=True, exist_ok=True)
+            item.write_bytes(content)
+            result += 1
+    return result
+
+
 def expand_path_items(src: dict) -> dict[str, str]:
     result = {}
     for path, content in src.items():
@@ -106,20 +145,176 @@ def parse_size(s):
         return int(s)
 
 
-@contextmanager
-def mounted(src: str, device: str = None, block_size: int = 512, size: int = None,
-            image_fn: str = None, fs: str = "lfs", ssid: str = None, passphrase: str = None,
-            nbd_server="nbd-server", endpoint="/mount", soft_reset: bool = True,
-            unmount: bool = True, baud_rate: int = 115200):
+class _NBDRequestHandler(socketserver.StreamRequestHandler):
+    def recv(self, n: int) -> bytes:
+        result = self.rfile.read(n)
+        if len(result) != n:
+            raise EOFError("connection closed")
+        return result
+
+    def handshake(self) -> bool:
+        w = self.wfile.write
+        w(b"NBDMAGICIHAVEOPT\x00\x03")  # fixed newstyle, no zeroes
+        client_flags, = unpack(">I", self.recv(4))
+        while True:
+            magic, option, length = unpack(">8sII", self.recv(16))
+            if magic != b"IHAVEOPT":
+                return False
+            data = self.recv(length)
+            if option == 1:  # export name
+                if data != self.server.name:
+                    logging.error(f"unknown export name {data}")
+                    return False
+                w(pack(">QH", self.server.device.size, 1))
+                if not client_flags & 2:
+                    w(bytes(124))
+                return True
+            elif option == 2:  # abort
+                return False
+            else:
+                w(pack(">QIII", 0x3e889045565a9, option, 0x80000001, 0))  # unsupported
+
+    def handle(self):
+        device, lock, trace = self.server.device, self.server.lock, self.server.trace
+        connection = "{}:{}".format(*self.client_address)
+        try:
+            if not self.handshake():
+                return
+            last_reply = None
+            while True:
+                magic, flags, t, handle, offset, length = unpack(">IHHQQI", self.recv(28))
+                arrival = perf_counter()
+                if magic != 0x25609513:
+                    logging.error(f"unexpected request magic: {magic:#x}")
+                    return
+                data = None
+                in_bounds = offset + length <= device.size
+                if t == 0:
+                    if in_bounds:
+                        data = bytearray(length)
+                        error = self.execute(lock, device.readinto, offset, data)
+                    else:
+                        error = 22  # EINVAL
+                elif t == 1:
+                    if in_bounds:
+                        error = self.execute(lock, device.write, offset, self.recv(length))
+                    else:
+                        for i in range(0, length, 0x10000):  # drain the payload
+                            self.recv(min(length - i, 0x10000))
+                        error = 22  # EINVAL
+                elif t == 2:
+                    return
+                else:
+                    error = 0 if t == 3 else 22  # flush is a no-op
+                self.wfile.write(pack(">IIQ", 0x67446698, error, handle))
+                if not error and data is not None:
+                    self.wfile.write(data)
+                now = perf_counter()
+                if trace is not None:
+                    # as seen by the device: request and payload transfer included
+                    trace.append((time(), now - (arrival if last_reply is None else last_reply),
+                                  connection, t, offset, length))
+                last_reply = now
+        except (EOFError, ConnectionError):
+            pass
+
+    @staticmethod
+    def execute(lock, action, offset, buf) -> int:
+        try:
+            with lock:
+                action(offset, buf)
+            return 0
+        except ValueError:
+            return 22  # EINVAL
+        except Exception as e:
+            logging.exception(e)
+            return 5  # EIO
+
+
+class NBDServer(socketserver.ThreadingTCPServer):
     """
-    Mount and unmount a copy of the provided folder.
+    A minimal NBD server exposing a block device.
 
     Parameters
     ----------
-    src
-        Folder to mount.
+    address
+        Host and port to listen to.
     device
-        The micropython device.
+        An object with `size` attribute and `readinto(offset, buf)`
+        and `write(offset, buf)` methods raising `ValueError` for
+        out-of-bounds requests.
+    name
+        Export name.
+    trace
+        If True, records all requests into `self.trace` as
+        tuples `(timestamp, duration, connection, command, offset, length)`.
+        The duration is the time from the previous reply on the same
+        connection (or from the arrival of the first request) to the
+        reply: it includes transferring the request over the link and
+        any pause the device makes between requests.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, device, name: bytes = b"", trace: bool = False):
+        self.device = device
+        self.name = name
+        self.lock = threading.Lock()
+        self.trace = [] if trace else None
+        super().__init__(address, _NBDRequestHandler)
+
+
+class ImageFile:
+    """
+    A block device backed by an image file.
+    Numbers of blocks written are collected into `dirty`.
+
+    Parameters
+    ----------
+    name
+        Image file name.
+    block_size
+        The size of the block.
+    """
+    def __init__(self, name: str, block_size: int = 512):
+        self.file = open(name, "r+b")
+        self.size = os.path.getsize(name)
+        self.block_size = block_size
+        self.dirty = set()
+
+    def _check_bounds(self, offset: int, length: int):
+        if offset < 0 or offset + length > self.size:
+            raise ValueError(f"out of bounds: {offset=} {length=} {self.size=}")
+
+    def readinto(self, offset: int, buf):
+        self._check_bounds(offset, len(buf))
+        self.file.seek(offset)
+        return self.file.readinto(buf)
+
+    def read(self, offset: int, length: int) -> bytes:
+        self._check_bounds(offset, length)
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def write(self, offset: int, buf):
+        self._check_bounds(offset, len(buf))
+        self.file.seek(offset)
+        self.file.write(buf)
+        self.file.flush()
+        self.dirty.update(range(offset // self.block_size, (offset + len(buf) - 1) // self.block_size + 1))
+
+    def close(self):
+        self.file.close()
+
+
+def compose_image(src, block_size: int = 512, size: int = None, image_fn: str = None, fs: str = "lfs"):
+    """
+    Composes a file system image with a copy of the provided folder.
+
+    Parameters
+    ----------
+    src
+        Folder to copy.
     block_size
         The size of the block.
     size
@@ -128,20 +323,10 @@ def mounted(src: str, device: str = None, block_size: int = 512, size: int = Non
         File name of the image composed.
     fs
         File system: FAT or littlefs.
-    ssid
-        Wireless network to employ.
-    passphrase
-        Wireless passphrase.
-    nbd_server
-        Local executable for network block device server.
-    endpoint
-        Where to mount to.
-    soft_reset
-        If True, soft-resets the board.
-    unmount
-        If True, unmounts automatically.
-    baud_rate
-        Baud rate for serial communications.
+
+    Returns
+    -------
+    The open image file.
     """
     if isinstance(src, str):
         copy_items, copy_size = collect_path(src)
@@ -203,6 +388,83 @@ def mounted(src: str, device: str = None, block_size: int = 512, size: int = Non
         image.fs._mark_clean()
 
     out_file.flush()
+    return out_file
+
+
+@contextmanager
+def mounted(src: str, device: str = None, block_size: int = 512, size: int = None,
+            image_fn: str = None, fs: str = "lfs", ssid: str = None, passphrase: str = None,
+            nbd_server="nbd-server", endpoint="/mount", soft_reset: bool = True,
+            unmount: bool = True, baud_rate: int = 115200, trace: str = None,
+            write_back: str = None):
+    """
+    Mount and unmount a copy of the provided folder.
+
+    Parameters
+    ----------
+    src
+        Folder to mount.
+    device
+        The micropython device.
+    block_size
+        The size of the block.
+    size
+        Total image size.
+    image_fn
+        File name of the image composed.
+    fs
+        File system: FAT, littlefs or virtual FAT
+        synthesized on the fly from the folder.
+    ssid
+        Wireless network to employ.
+    passphrase
+        Wireless passphrase.
+    nbd_server
+        Local executable for network block device server.
+        Not used with `fs="vfat"`, `trace` or `write_back`.
+    endpoint
+        Where to mount to.
+    soft_reset
+        If True, soft-resets the board.
+    unmount
+        If True, unmounts automatically.
+    baud_rate
+        Baud rate for serial communications.
+    trace
+        If set, serves the image with the built-in NBD
+        server and writes a per-file access report to
+        this file name when done. Raw requests are
+        written next to it as `{trace}.csv`. The built-in
+        server replaces `nbd_server` and serves requests
+        one at a time, so timings may differ from the
+        ones with `nbd_server`.
+    write_back
+        If set, serves the image with the built-in NBD
+        server, tracks blocks written by the device and
+        writes files affected back to this folder when done
+        and the device unmounted (pass `src` to update the
+        source folder in place).
+        The yielded board also gets a `write_back()` method
+        doing the same on demand. Deleted files are not
+        removed from the folder. With `unmount=False` the
+        device is still mounted when writing back: files
+        it has not flushed yet are missed or incomplete.
+    """
+    if write_back is not None and not unmount:
+        logging.warning("writing back while the device is still mounted: unflushed files will be missed")
+    if fs == "vfat":
+        logging.info("using virtual FAT")
+        from vfat import VirtualFAT
+
+        image = VirtualFAT(src, sector_size=block_size, size=size)
+        logging.info(f"  args: image_size={pretty_memory(image.size)} sector_size={block_size}")
+    else:
+        out_file = compose_image(src, block_size=block_size, size=size, image_fn=image_fn, fs=fs)
+        image_fn = str(Path(out_file.name).absolute())
+        if trace is not None or write_back is not None:
+            image = ImageFile(image_fn, block_size)
+        else:
+            image = None
 
     # communicate with the board
     logging.info("connecting to board and checking network capabilities")
@@ -226,6 +488,15 @@ def mounted(src: str, device: str = None, block_size: int = 512, size: int = Non
 
     board.enter_raw_repl(soft_reset=soft_reset)
 
+    def _unmount():
+        nonlocal unmount
+        if unmount:
+            unmount = False
+            logging.info("unmounting")
+            pipe(*board.exec_raw(f"import os; os.umount({repr(endpoint)})"), None)
+            board.exit_raw_repl()
+            board.close()
+
     try:
         # determine network
         pipe(*board.exec_raw("import network"), "no 'network' module or import error")
@@ -283,20 +554,26 @@ def mounted(src: str, device: str = None, block_size: int = 512, size: int = Non
         else:
             logging.info("skip network setup (already connected)")
 
-        # chmod: in case nbd-server complains
-        os.chmod(out_file.name, 0o666)
         # determine server host and port
         host = socket.gethostbyname(socket.gethostname())
         port = free_tcp_port()
         logging.info(f"using {host}:{port} as nbd server")
         # start NBD server
-        nbd_process = subprocess.Popen([*nbd_server.split(), str(port), image_fn, "-d"],
-                                       stdout=sys.stdout, stderr=sys.stderr)
-        sleep(0.1)
+        if image is not None:
+            if fs != "vfat" and nbd_server != "nbd-server":
+                logging.warning(f"serving with the built-in NBD server instead of '{nbd_server}'")
+            nbd_process = NBDServer(("", port), image, trace=trace is not None)
+            threading.Thread(target=nbd_process.serve_forever, daemon=True).start()
+        else:
+            # chmod: in case nbd-server complains
+            os.chmod(out_file.name, 0o666)
+            nbd_process = subprocess.Popen([*nbd_server.split(), str(port), image_fn, "-d"],
+                                           stdout=sys.stdout, stderr=sys.stderr)
+            sleep(0.1)
 
         logging.info("mounting")
         pipe(*board.exec_raw(getsource(unbd)), "error while injecting 'unbd.py'")
-        if fs == "fat":
+        if fs in ("fat", "vfat"):
             _what = f"os.VfsFat(connect({repr(host)}, {repr(port)}, {repr(block_size)}))"
         elif fs == "lfs":
             _what = f"os.VfsLfs2(connect({repr(host)}, {repr(port)}, {repr(block_size)}), readsize={repr(block_size)})"
@@ -306,20 +583,52 @@ def mounted(src: str, device: str = None, block_size: int = 512, size: int = Non
             logging.info("no unmount requested, releasing REPL")
             board.exit_raw_repl()
             board.close()
+        if write_back is not None:
+            def _write_back():
+                from blocktrace import changed_files
+
+                with nbd_process.lock:
+                    items = changed_files(image, fs, block_size, image.dirty)
+                    image.dirty.clear()
+                n = write_items(items, write_back)
+                logging.info(f"{n} files written back to {write_back}")
+                return n
+
+            board.write_back = _write_back
         logging.info("ready")
         try:
             yield board
         finally:
             logging.info("done")
-            nbd_process.terminate()
-            nbd_process.kill()
-            logging.info("NBD server terminated")
+            try:
+                # unmount while serving: the device flushes files and caches
+                _unmount()
+            finally:
+                try:
+                    if trace is not None:
+                        from blocktrace import image_ranges, attribute, format_report, write_csv
+
+                        requests = list(nbd_process.trace)
+                        with nbd_process.lock:
+                            ranges = image_ranges(image, fs, block_size)
+                        with open(trace, "w") as f:
+                            f.write(format_report(attribute(requests, ranges)))
+                        with open(f"{trace}.csv", "w", newline="") as f:
+                            write_csv(requests, f)
+                        logging.info(f"access report written to {trace}, requests to {trace}.csv")
+                    if write_back is not None:
+                        _write_back()
+                finally:
+                    if image is not None:
+                        nbd_process.shutdown()
+                        nbd_process.server_close()
+                        image.close()
+                    else:
+                        nbd_process.terminate()
+                        nbd_process.kill()
+                    logging.info("NBD server terminated")
     finally:
-        if unmount:
-            logging.info("unmounting")
-            pipe(*board.exec_raw(f"import os; os.umount({repr(endpoint)})"), None)
-            board.exit_raw_repl()
-            board.close()
+        _unmount()
 
 
 def main():
@@ -330,7 +639,7 @@ def main():
     arg_parser.add_argument("--block-size", help="block size", metavar="SIZE", type=int,
                             default=512, choices=[0x200, 0x400, 0x800, 0x1000])
     arg_parser.add_argument("--size", help="total image size", metavar="SIZE")
-    arg_parser.add_argument("--fs", help="fs choice", metavar="FS", choices=["fat", "lfs"], default="lfs")
+    arg_parser.add_argument("--fs", help="fs choice", metavar="FS", choices=["fat", "lfs", "vfat"], default="lfs")
     arg_parser.add_argument("--ssid", help="SSID to connect to", default=None)
     arg_parser.add_argument("--passphrase", help="wifi network passphrase", default=None)
     arg_parser.add_argument("--addr", help="address of the NBD host", default=None)
@@ -339,8 +648,13 @@ def main():
     arg_parser.add_argument("--soft-reset", help="soft-resets the board", action="store_true")
     arg_parser.add_argument("--payload", help="payload on the micropython device")
     arg_parser.add_argument("--baud-rate", help="serial baud rate", metavar="N", type=int, default=115200)
+    arg_parser.add_argument("--trace", help="write per-file block access report (raw requests go to REPORT.csv)", metavar="REPORT", default=None)
+    arg_parser.add_argument("--write-back", help="write files changed by the device back to the source or to FOLDER",
+                            metavar="FOLDER", nargs="?", const=True, default=None)
     arg_parser.add_argument("--verbose", help="verbose printing", action="store_true")
     args = arg_parser.parse_args()
+    if args.write_back is not None and args.payload is None:
+        arg_parser.error("--write-back requires --payload: without it the device is not unmounted before writing back")
 
     logging.basicConfig(
         format="[%(levelname)s] %(asctime)s %(message)s",
@@ -352,7 +666,8 @@ def main():
                  size=None if args.size is None else parse_size(args.size),
                  image_fn=args.image_fn, fs=args.fs, ssid=args.ssid, passphrase=args.passphrase,
                  nbd_server=args.nbd_server, endpoint=args.endpoint, soft_reset=args.soft_reset,
-                 unmount=args.payload is not None, baud_rate=args.baud_rate) as board:
+                 unmount=args.payload is not None, baud_rate=args.baud_rate, trace=args.trace,
+                 write_back=args.src if args.write_back is True else args.write_back) as board:
         if args.payload is None:
             while True:
                 sleep(10_000)
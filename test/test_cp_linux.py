@@ -1,15 +1,29 @@
 import subprocess
 import sys
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from tempfile import NamedTemporaryFile
 from time import sleep
 import os
 from pathlib import Path
+from threading import Thread
+from functools import partial
+import re
+from multiprocessing import Process
+import tracemalloc
+import csv
+import io
 
 import pytest
 from conftest import nbd_server_cmd
 
-from unbd import Client
+from pyfatfs.PyFatFS import PyFatFS
+from littlefs import LittleFS, UserContext
+
+from unbd import Client, connect, _rq_message
+import snapmount
+from snapmount import mounted, NBDServer, ImageFile, compose_image, write_items
+from blocktrace import image_ranges, attribute, format_report, write_csv, changed_files
+from vfat import VirtualFAT
 
 
 @contextmanager
@@ -58,3 +72,297 @@ def test_write_out_of_bounds(port=33567, data=b"Hello world"):
             with pytest.raises(RuntimeError):
                 c.write(10, b"xxx")
         assert file.read() == data
+
+
+@contextmanager
+def vfat_server(src, block_size=512, trace=False):
+    image = VirtualFAT(src, sector_size=block_size)
+    server = NBDServer(("localhost", 0), image, trace=trace)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server, image
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("block_size", [512, 4096])
+def test_vfat(tmp_path, block_size):
+    (tmp_path / "src" / "some" / "folder").mkdir(parents=True)
+    (tmp_path / "src" / "empty").mkdir()
+    (tmp_path / "src" / "hello.txt").write_text("Hello world")
+    (tmp_path / "src" / "some" / "folder" / "A long file name.bin").write_bytes(os.urandom(100_000))
+
+    with vfat_server(str(tmp_path / "src"), block_size) as (server, image):
+        with Client('localhost', server.server_address[1]) as c:
+            assert c.size == image.size
+            (tmp_path / "fs.img").write_bytes(c.read(0, c.size))
+
+    fs = PyFatFS(str(tmp_path / "fs.img"))
+    try:
+        assert sorted(fs.listdir("/")) == ["empty", "hello.txt", "some"]
+        assert fs.listdir("/empty") == []
+        assert fs.readtext("/hello.txt") == "Hello world"
+        assert fs.readbytes("/some/folder/A long file name.bin") == \
+               (tmp_path / "src" / "some" / "folder" / "A long file name.bin").read_bytes()
+    finally:
+        fs.close()
+
+
+def test_vfat_non_bmp_names(tmp_path):
+    names = [f"{'😀' * 20}{i}.txt" for i in range(30)]
+    with vfat_server({**{f"/d/{i}": i for i in names}, **{f"/{i}": i for i in names}}) as (server, image):
+        with Client('localhost', server.server_address[1]) as c:
+            (tmp_path / "fs.img").write_bytes(c.read(0, c.size))
+
+    fs = PyFatFS(str(tmp_path / "fs.img"))
+    try:
+        assert sorted(fs.listdir("/d")) == sorted(names)
+        assert sorted(fs.listdir("/")) == sorted(names + ["d"])
+        assert fs.readtext(f"/d/{names[-1]}") == names[-1]
+    finally:
+        fs.close()
+
+
+def test_vfat_write():
+    with vfat_server({"/hello.txt": "Hello world"}) as (server, image):
+        buffers = []
+        image.readinto = lambda offset, buf, _readinto=image.readinto: buffers.append(len(buf)) or _readinto(offset, buf)
+        with Client('localhost', server.server_address[1]) as c:
+            c.write(100, b"hola")
+            c.write(1000, b"x" * 1000)
+            assert c.read(98, 8) == b"\x00\x00hola\x00\x00"
+            assert c.read(999, 1002) == b"\x00" + b"x" * 1000 + b"\x00"
+            with pytest.raises(RuntimeError):
+                c.write(c.size - 1, b"xx")
+            assert c.read(c.size - 1, 1) == b"\x00"
+            c._socket.sendall(_rq_message(0, 0, 0xFFFFFFFF))  # would not fit in memory
+            with pytest.raises(RuntimeError):
+                c._assert_response()
+            assert c.read(98, 8) == b"\x00\x00hola\x00\x00"
+        assert max(buffers) < image.size
+        assert sorted(image.overlay) == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("fs", ["vfat", "lfs"])
+def test_trace(fs):
+    src = {"/hello.txt": "Hello world", "/some/data.bin": b"x" * 2000, "/some/folder/c.txt": "c"}
+    with compose_image(src, fs="lfs") if fs == "lfs" else nullcontext() as f:
+        image = ImageFile(f.name) if fs == "lfs" else VirtualFAT(src)
+        ranges = image_ranges(image, fs, 512)
+        labels = {i[2] for i in ranges}
+        assert {"<dir />", "<dir /some>", "<dir /some/folder>", "/some/data.bin"} <= labels
+        folder = next(i for i in ranges if i[2] == "<dir /some>")
+        start, end, _ = next(i for i in ranges if i[2] == "/some/data.bin")
+
+        server = NBDServer(("localhost", 0), image, trace=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with Client('localhost', server.server_address[1]) as c:
+                c.read(folder[0], 512)
+                sleep(0.1)
+                c.read(start, 1024 if end - start >= 1024 else 512)
+                c.write(start, b"y" * 512)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    assert [i[3] for i in server.trace] == [0, 0, 1]
+    assert server.trace[0][1] < 0.1 <= server.trace[1][1]  # time between requests is included
+    stats = attribute(server.trace, ranges)
+    assert stats["<dir /some>"][:3] == [1, 512, 0]
+    assert stats["/some/data.bin"][0] == 2
+    assert stats["/some/data.bin"][2] == 512
+    assert stats["/some/data.bin"][3] >= 0.1
+    assert "/some/data.bin" in format_report(stats)
+
+    f = io.StringIO()
+    write_csv(server.trace, f)
+    rows = list(csv.reader(io.StringIO(f.getvalue())))
+    assert rows[0] == ["timestamp", "duration", "connection", "command", "offset", "length"]
+    assert [i[3:] for i in rows[1:]] == [["read", str(folder[0]), "512"],
+                                         ["read", str(start), str(server.trace[1][5])],
+                                         ["write", str(start), "512"]]
+
+
+def _write_changed_blocks(write, old, new, block_size=512):
+    for i in range(0, len(new), block_size):
+        if old[i:i + block_size] != new[i:i + block_size]:
+            write(i, new[i:i + block_size])
+
+
+def test_write_back_fat(tmp_path):
+    src = tmp_path / "src"
+    (src / "logs").mkdir(parents=True)
+    (src / "hello.txt").write_text("Hello world")
+    (src / "logs" / "0.txt").write_text("log 0")
+    (src / "data").mkdir()
+    (src / "data" / "untouched.txt").write_text("untouched")
+
+    with vfat_server(str(src)) as (server, image):
+        with Client('localhost', server.server_address[1]) as c:
+            old = c.read(0, c.size)
+            (tmp_path / "fs.img").write_bytes(old)
+            fs = PyFatFS(str(tmp_path / "fs.img"))
+            fs.writetext("/logs/1.txt", "log 1")
+            fs.writetext("/hello.txt", "Hola mundo")
+            fs.makedir("/new")
+            fs.close()
+            _write_changed_blocks(c.write, old, (tmp_path / "fs.img").read_bytes())
+
+        items = changed_files(image, "vfat", 512, image.dirty)
+    assert "/data/untouched.txt" not in items
+    assert items["/logs/1.txt"] == b"log 1"
+    assert write_items(items, str(src)) == 2
+    assert (src / "logs" / "1.txt").read_text() == "log 1"
+    assert (src / "hello.txt").read_text() == "Hola mundo"
+    assert (src / "new").is_dir()
+
+
+def test_write_back_fat_records(tmp_path):
+    src = {"/data/big.bin": os.urandom(100_000), **{f"/data/f{i:02d}.txt": f"{i}" for i in range(20)}}
+    with vfat_server(src) as (server, image):
+        with Client('localhost', server.server_address[1]) as c:
+            old = c.read(0, c.size)
+            (tmp_path / "fs.img").write_bytes(old)
+            fs = PyFatFS(str(tmp_path / "fs.img"))
+            fs.writetext("/data/new.txt", "new")
+            fs.close()
+            _write_changed_blocks(c.write, old, (tmp_path / "fs.img").read_bytes())
+
+        items = changed_files(image, "vfat", 512, image.dirty)
+    assert items["/data/new.txt"] == b"new"
+    assert "/data/big.bin" not in items  # folder table records in a different sector
+    assert "/data/f00.txt" not in items
+
+
+@pytest.mark.parametrize("name", ["/../escaped.txt", "/a/../../escaped.txt", "/link/escaped.txt"])
+def test_write_items_outside(tmp_path, name):
+    (tmp_path / "dst").mkdir()
+    (tmp_path / "dst" / "link").symlink_to(tmp_path)
+    with pytest.raises(ValueError):
+        write_items({"/fine.txt": b"x", name: b"x"}, str(tmp_path / "dst"))
+    assert not (tmp_path / "escaped.txt").exists()
+    assert not (tmp_path / "dst" / "fine.txt").exists()
+
+
+def test_write_back_lfs(tmp_path):
+    with compose_image({"/hello.txt": "Hello world", "/data/untouched.txt": "untouched"}) as f:
+        image = ImageFile(f.name)
+        old = image.read(0, image.size)
+        fs = LittleFS(context=UserContext(buffer=bytearray(old)), block_size=512,
+                      block_count=image.size // 512)
+        fs.makedirs("/logs")
+        with fs.open("/logs/1.txt", "w") as f_log:
+            f_log.write("log 1")
+        fs.unmount()
+        _write_changed_blocks(image.write, old, fs.context.buffer)
+        reads = []
+        image.read = lambda offset, length, _read=image.read: reads.append(length) or _read(offset, length)
+        items = changed_files(image, "lfs", 512, image.dirty)
+    assert "/data/untouched.txt" not in items
+    assert max(reads) <= 512  # block by block
+    (tmp_path / "hello.txt").write_text("Hello world")
+    assert write_items(items, str(tmp_path)) == 1
+    assert (tmp_path / "logs" / "1.txt").read_text() == "log 1"
+    assert not (tmp_path / "data").exists()
+
+
+# traced (cpython) allocation limits for unbd
+MAX_CONNECTION_FOOTPRINT = 4096  # a buffered socket file alone takes 8 KiB
+MAX_IO_GROWTH = 256  # nothing retained across 32 block requests
+MAX_IO_PEAK = 512  # less than the smallest block: no block-sized copies
+
+
+@pytest.mark.parametrize("block_size", [512, 4096])
+def test_memory_footprint(tmp_path, block_size):
+    (tmp_path / "fs.img").write_bytes(os.urandom(16 * block_size))
+    server = NBDServer(("localhost", 0), ImageFile(str(tmp_path / "fs.img"), block_size))
+    p = Process(target=server.serve_forever, daemon=True)  # keep server allocations out of the trace
+    p.start()
+    buf = bytearray(block_size)
+    try:
+        tracemalloc.start()
+        try:
+            device = connect('localhost', server.server_address[1], block_size=block_size, open=True)
+            per_connection, _ = tracemalloc.get_traced_memory()
+            device.readblocks(0, buf)
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            for i in range(16):
+                device.readblocks(i, buf)
+                device.writeblocks(i, buf)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        device.ioctl(2, 0)
+    finally:
+        p.terminate()
+        server.server_close()
+    # see "Memory footprint" in README.md for measured values
+    assert per_connection < MAX_CONNECTION_FOOTPRINT
+    assert after - before < MAX_IO_GROWTH
+    assert peak - before < MAX_IO_PEAK
+
+
+def test_vfat_open_files(tmp_path, monkeypatch):
+    (tmp_path / "big.bin").write_bytes(os.urandom(0x40000))
+    image = VirtualFAT(str(tmp_path))
+    start, end, _ = next(i for i in image_ranges(image, "vfat", 512) if i[2] == "/big.bin")
+    opened = []
+    monkeypatch.setattr("builtins.open", lambda *args, _open=open: opened.append(args) or _open(*args))
+    data = b"".join(image.read(i, 512) for i in range(start, end, 512))
+    image.close()
+    assert data == (tmp_path / "big.bin").read_bytes()
+    assert len(opened) == 1
+
+
+class _FlushingBoard:
+    """A board stand-in flushing a log file into the image when unmounting."""
+    def __init__(self, device, baudrate, work_dir=None):
+        self.work_dir = work_dir
+        self.address = None
+
+    def enter_raw_repl(self, soft_reset=True):
+        pass
+
+    def exit_raw_repl(self):
+        pass
+
+    def close(self):
+        pass
+
+    def exec_raw(self, command):
+        if "os.mount(" in command:
+            host, port = re.search(r"connect\('([^']+)', (\d+)", command).groups()
+            self.address = host, int(port)
+        elif "os.umount(" in command:
+            with Client(*self.address) as c:
+                old = c.read(0, c.size)
+                (self.work_dir / "fs.img").write_bytes(old)
+                fs = PyFatFS(str(self.work_dir / "fs.img"))
+                fs.writetext("/log.txt", "flushed at unmount")
+                fs.close()
+                _write_changed_blocks(c.write, old, (self.work_dir / "fs.img").read_bytes())
+        return b"False\n" if "ifconfig" in command else b"", b""
+
+
+def test_mounted_write_back_after_unmount(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "hello.txt").write_text("Hello world")
+    monkeypatch.setattr(snapmount, "Pyboard", partial(_FlushingBoard, work_dir=tmp_path))
+
+    with mounted(str(src), device="fake", fs="vfat", write_back=str(src), trace=str(tmp_path / "report.txt")):
+        pass
+
+    assert (src / "log.txt").read_text() == "flushed at unmount"
+    assert "/log.txt" in (tmp_path / "report.txt").read_text()
+    assert ",write," in (tmp_path / "report.txt.csv").read_text()
+
+
+def test_write_back_requires_payload(tmp_path):
+    p = subprocess.run([sys.executable, snapmount.__file__, str(tmp_path), "--write-back"],
+                       capture_output=True, text=True)
+    assert p.returncode == 2
+    assert "--write-back requires --payload" in p.stderr
@@ -1,11 +1,14 @@
-from struct import pack, pack_into, unpack
+from struct import pack, pack_into, unpack_from
 import socket
 
+# the only scratch buffer shared by all connections:
+# requests, replies and handshake messages
+_work = bytearray(28)
 
-def _rq_message(t, offset, length, _work=bytearray(b"\x25\x60\x95\x13" + b"\x00" * 24)):
+
+def _rq_message(t, offset, length):
     # pack(">IHHQQI", 0x25609513, 0, t, _handle, offset, len(buf))
-    _work[7] = t
-    pack_into(">QI", _work, 16, offset, length)
+    pack_into(">IHHQQI", _work, 0, 0x25609513, 0, t, 0, offset, length)
     return _work
 
 
@@ -16,7 +19,7 @@ class Client:
         self.name = name
         self.socket_timeout = timeout
 
-        self._socket = self._readinto = self._write = self.size = None
+        self._socket = self._readinto = self.size = None
 
         if open:
             self.open()
@@ -25,44 +28,54 @@ class Client:
         self._socket = s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(self.socket_timeout)
         s.connect((self.host, self.port))
-        f = s.makefile('br')
-        self._readinto, self._write = f.readinto, s.sendall
+        # micropython streams read in full; cpython needs recv_into
+        self._readinto = getattr(s, "readinto", None) or s.recv_into
 
         self.hello()
         self.size = self.select_export(self.name)
 
+    def _recv(self, buf, n):
+        result = self._readinto(buf, n)
+        if result is not None and result < n:
+            # partial reads (cpython)
+            buf = memoryview(buf)
+            while result < n:
+                chunk = self._readinto(buf[result:n])
+                if not chunk:
+                    break
+                result += chunk
+        return result
+
     def hello(self):
-        buf = bytearray(18)
-        if self._readinto(buf) != 18 or buf != b'NBDMAGICIHAVEOPT\x00\x03':
-            raise RuntimeError(f"unexpected hello: {buf}")
-        self._write(b'\x00\x00\x00\x03')
+        if self._recv(_work, 18) != 18 or _work[:18] != b'NBDMAGICIHAVEOPT\x00\x03':
+            raise RuntimeError(f"unexpected hello: {_work[:18]}")
+        self._socket.sendall(b'\x00\x00\x00\x03')
 
     def select_export(self, name: bytes):
-        w = self._write
+        w = self._socket.sendall
         w(pack(">8sII", b"IHAVEOPT", 1, len(name)))
         if len(name):
             w(name)
-        buf = bytearray(10)
-        if self._readinto(buf) < 10:
+        if self._recv(_work, 10) != 10:
             raise RuntimeError("probably a non-existing export name")
-        size, flags = unpack(">QH", buf)
+        size, flags = unpack_from(">QH", _work)
         return size
 
-    def _assert_response(self, handle=0, _buffer=bytearray(16)):
-        self._readinto(_buffer)
-        if _buffer[:8] != b"\x67\x44\x66\x98\x00\x00\x00\x00":
-            raise RuntimeError(f"failed response header or request error: {_buffer}")
-        r_handle = int.from_bytes(_buffer[8:], "big")
+    def _assert_response(self, handle=0):
+        self._recv(_work, 16)
+        if _work[:8] != b"\x67\x44\x66\x98\x00\x00\x00\x00":
+            raise RuntimeError(f"failed response header or request error: {_work[:16]}")
+        r_handle = int.from_bytes(_work[8:16], "big")
         if r_handle != handle:
             raise RuntimeError(f"unexpected response handle: {r_handle} != {handle}")
 
     def readinto(self, offset, buf):
-        self._write(_rq_message(0, offset, len(buf)))
+        self._socket.sendall(_rq_message(0, offset, len(buf)))
         self._assert_response()
-        return self._readinto(buf)
+        return self._recv(buf, len(buf))
 
     def write(self, offset, buf):
-        w = self._write
+        w = self._socket.sendall
         w(_rq_message(1, offset, len(buf)))
         w(buf)
         self._assert_response()
@@ -74,10 +87,10 @@ class Client:
 
     def close(self):
         try:
-            self._write(_rq_message(2, 0, 0))
+            self._socket.sendall(_rq_message(2, 0, 0))
         finally:
             self._socket.close()
-            self._socket = self._readinto = self._write = None
+            self._socket = self._readinto = None
 
     def __enter__(self):
         self.open()
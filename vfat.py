@@ -0,0 +1,393 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from struct import pack, pack_into
+
+_SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+_ATTR_DIRECTORY = 0x10
+_ATTR_ARCHIVE = 0x20
+_ATTR_LFN = 0x0F
+_MIN_CLUSTERS = 0x1000
+_MAX_CLUSTERS = 0xFFF4
+_MAX_OPEN_FILES = 8
+
+
+class _Entry:
+    """A file or a folder of the virtual image."""
+    def __init__(self, name: str, source=None, size: int = 0, mtime: float = None):
+        self.name = name
+        self.source = source  # host Path or bytes for files
+        self.size = size
+        self.mtime = mtime
+        self.children = None  # dict for folders
+        self.cluster = 0
+        self.n_clusters = 0
+        self.data = None  # directory table for folders
+
+    @property
+    def is_dir(self) -> bool:
+        return self.children is not None
+
+
+def _ceil_div(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def _fat_datetime(timestamp: float) -> (int, int):
+    if timestamp is None:
+        return 0x21, 0  # 1980-01-01 00:00
+    t = datetime.fromtimestamp(timestamp)
+    if t.year < 1980:
+        return 0x21, 0
+    return ((t.year - 1980) << 9) | (t.month << 5) | t.day, (t.hour << 11) | (t.minute << 5) | (t.second // 2)
+
+
+def _short_name(name: str, taken: set) -> (bytes, bool):
+    """
+    Picks an 8.3 name for the entry.
+
+    Parameters
+    ----------
+    name
+        The long file name.
+    taken
+        Short names already present in the folder.
+
+    Returns
+    -------
+    The 11-byte short name and a flag telling whether
+    long file name entries are needed.
+    """
+    base, dot, ext = name.rpartition(".")
+    if not dot or not base:
+        base, ext = name, ""
+    if (
+        name == name.upper() and 0 < len(base) <= 8 and len(ext) <= 3
+        and set(base) <= _SHORT_NAME_CHARS and set(ext) <= _SHORT_NAME_CHARS
+    ):
+        result = f"{base:<8}{ext:<3}".encode()
+        if result not in taken:
+            return result, False
+
+    def _clean(s):
+        return "".join(c if c in _SHORT_NAME_CHARS else "_" for c in s.upper() if c not in " .")
+
+    base, ext = _clean(base), _clean(ext)[:3]
+    for i in range(1, 1_000_000):
+        tail = f"~{i}"
+        result = f"{base[:8 - len(tail)] + tail:<8}{ext:<3}".encode()
+        if result not in taken:
+            return result, True
+    raise ValueError(f"failed to pick a short name for {name}")
+
+
+def _short_name_checksum(short_name: bytes) -> int:
+    result = 0
+    for c in short_name:
+        result = (((result & 1) << 7) + (result >> 1) + c) & 0xFF
+    return result
+
+
+def _dir_record(short_name: bytes, attr: int, cluster: int, size: int, mtime: float) -> bytes:
+    date, time = _fat_datetime(mtime)
+    return pack("<11sBBBHHHHHHHI", short_name, attr, 0, 0, time, date, date, 0, time, date, cluster, size)
+
+
+def _lfn_records(name: str, short_name: bytes) -> list[bytes]:
+    encoded = name.encode("utf-16-le")
+    if len(encoded) > 510:
+        raise ValueError(f"file name too long: {name}")
+    if len(encoded) % 26:
+        encoded += b"\x00\x00"
+        encoded += b"\xff" * (-len(encoded) % 26)
+    checksum = _short_name_checksum(short_name)
+    result = []
+    n = len(encoded) // 26
+    for i in range(n):
+        chunk = encoded[26 * i:26 * (i + 1)]
+        seq = i + 1 if i < n - 1 else (i + 1) | 0x40
+        result.append(pack("<B10sBBB12sH4s", seq, chunk[:10], _ATTR_LFN, 0, checksum, chunk[10:22], 0, chunk[22:]))
+    return result[::-1]
+
+
+def _directory_table(entries: list[_Entry]) -> bytearray:
+    result = bytearray()
+    taken = set()
+    for e in entries:
+        short_name, needs_lfn = _short_name(e.name, taken)
+        taken.add(short_name)
+        if needs_lfn:
+            for r in _lfn_records(e.name, short_name):
+                result += r
+        result += _dir_record(short_name, _ATTR_DIRECTORY if e.is_dir else _ATTR_ARCHIVE,
+                              e.cluster, 0 if e.is_dir else e.size, e.mtime)
+    return result
+
+
+class VirtualFAT:
+    """
+    A FAT16 image synthesized on the fly.
+
+    Only the boot sector, the allocation table and
+    directory tables are kept in memory: file contents
+    are read from the source on demand. The image is
+    writable: modified sectors are kept in memory and
+    take precedence over the synthesized ones. Numbers of
+    sectors written are collected into `dirty`.
+
+    Parameters
+    ----------
+    src
+        Root folder on the host or a dictionary
+        `{file_name: file_content}` where folders
+        have `None` content.
+    sector_size
+        The size of the sector (block size).
+    size
+        Minimal total image size.
+    """
+    def __init__(self, src, sector_size: int = 512, size: int = None):
+        self.sector_size = sector_size
+        self.root = _Entry("")
+        self.root.children = {}
+        if isinstance(src, dict):
+            self._collect_items(src)
+        else:
+            self._collect_path(src)
+        self.overlay = {}
+        self.dirty = set()
+        self._files = OrderedDict()  # open host files, least recently used first
+        self._layout(size or 0)
+
+    def _add(self, path: str) -> _Entry:
+        node = self.root
+        for part in Path(path).parts:
+            if part in ("/", "."):
+                continue
+            if not node.is_dir:
+                raise ValueError(f"not a directory: {node.name}")
+            if part not in node.children:
+                child = node.children[part] = _Entry(part)
+                child.children = {}
+            node = node.children[part]
+        return node
+
+    def _collect_items(self, src: dict):
+        for name, content in src.items():
+            if content is None:
+                self._add(name)
+            else:
+                if isinstance(content, str):
+                    content = content.encode()
+                parent, name = Path(name).parent, Path(name).name
+                self._add(str(parent)).children[name] = _Entry(name, bytes(content), len(content))
+
+    def _collect_path(self, src: str):
+        src = Path(src)
+        if not src.is_dir():
+            raise ValueError(f"not a directory: {src}")
+        for item in sorted(src.glob("**/*")):
+            item_ = item.relative_to(src)
+            if item.is_dir():
+                self._add(str(item_)).mtime = item.stat().st_mtime
+            elif item.is_file():
+                stat = item.stat()
+                self._add(str(item_.parent)).children[item_.name] = _Entry(
+                    item_.name, item, stat.st_size, stat.st_mtime)
+
+    def _walk(self, node: _Entry = None):
+        if node is None:
+            node = self.root
+        for child in node.children.values():
+            yield child
+            if child.is_dir:
+                yield from self._walk(child)
+
+    def _layout(self, size: int):
+        ss = self.sector_size
+        # number of directory records per folder: LFN records are
+        # counted for all entries as an upper bound (UTF-16 code units)
+        n_records = {}
+        for e in [self.root, *self._walk()]:
+            if e.is_dir:
+                n_records[e] = sum(1 + _ceil_div(len(c.name.encode("utf-16-le")) // 2 + 1, 13)
+                                   for c in e.children.values())
+
+        root_entries = max(512, _ceil_div(n_records[self.root] * 32, ss) * ss // 32)
+        if root_entries > 0xFFFF:
+            raise ValueError("too many items in the root folder")
+        root_sectors = root_entries * 32 // ss
+        reserved_sectors = 1
+
+        spc = 1
+        while True:
+            cluster_size = spc * ss
+            if cluster_size > 0x8000:
+                raise ValueError("the source is too large for FAT16")
+            used = sum(
+                _ceil_div(n_records[e] * 32 + 64, cluster_size) if e.is_dir else _ceil_div(e.size, cluster_size)
+                for e in self._walk()
+            )
+            clusters = max(_MIN_CLUSTERS, used + used // 2 + 1)
+            fat_sectors = _ceil_div((clusters + 2) * 2, ss)
+            system_sectors = reserved_sectors + 2 * fat_sectors + root_sectors
+            clusters = max(clusters, (size // ss - system_sectors) // spc)
+            fat_sectors = _ceil_div((clusters + 2) * 2, ss)
+            if clusters <= _MAX_CLUSTERS:
+                break
+            spc *= 2
+
+        self.sectors_per_cluster = spc
+        self.cluster_size = cluster_size
+        self.cluster_count = clusters
+        self.fat_sectors = fat_sectors
+        self.root_entries = root_entries
+        self.fat_start = reserved_sectors
+        self.root_start = reserved_sectors + 2 * fat_sectors
+        self.data_start = self.root_start + root_sectors
+        self.sector_count = self.data_start + clusters * spc
+        self.size = self.sector_count * ss
+
+        # allocate clusters
+        fat = self.fat = bytearray(fat_sectors * ss)
+        pack_into("<HH", fat, 0, 0xFFF8, 0xFFFF)
+        self._starts = []
+        self._owners = []
+        cluster = 2
+        for e in self._walk():
+            e.n_clusters = _ceil_div(n_records[e] * 32 + 64, cluster_size) if e.is_dir else _ceil_div(e.size, cluster_size)
+            if e.n_clusters:
+                e.cluster = cluster
+                for i in range(cluster, cluster + e.n_clusters - 1):
+                    pack_into("<H", fat, 2 * i, i + 1)
+                pack_into("<H", fat, 2 * (cluster + e.n_clusters - 1), 0xFFFF)
+                self._starts.append(cluster)
+                self._owners.append(e)
+                cluster += e.n_clusters
+        self.free_cluster = cluster
+
+        # directory tables
+        self.root.data = _directory_table(list(self.root.children.values()))
+        assert len(self.root.data) <= root_sectors * ss, "root folder table overflow"
+        self.root.data += bytes(root_sectors * ss - len(self.root.data))
+        stack = [(self.root, 0)]
+        while stack:
+            node, parent_cluster = stack.pop()
+            for e in node.children.values():
+                if e.is_dir:
+                    e.data = (
+                        _dir_record(b".          ", _ATTR_DIRECTORY, e.cluster, 0, e.mtime)
+                        + _dir_record(b"..         ", _ATTR_DIRECTORY, parent_cluster, 0, e.mtime)
+                        + _directory_table(list(e.children.values()))
+                    )
+                    assert len(e.data) <= e.n_clusters * cluster_size, f"folder table overflow: {e.name}"
+                    e.data += bytes(e.n_clusters * cluster_size - len(e.data))
+                    stack.append((e, e.cluster))
+
+        # boot sector
+        boot = self.boot = bytearray(ss)
+        pack_into(
+            "<3s8sHBHBHHBHHHII", boot, 0,
+            b"\xEB\x3C\x90", b"MSDOS5.0", ss, spc, reserved_sectors, 2, root_entries,
+            self.sector_count if self.sector_count < 0x10000 else 0,
+            0xF8, fat_sectors, 63, 255, 0,
+            self.sector_count if self.sector_count >= 0x10000 else 0,
+        )
+        pack_into("<BBBI11s8s", boot, 36, 0x80, 0, 0x29, 0x756e6264, b"NO NAME    ", b"FAT16   ")
+        boot[510:512] = b"\x55\xAA"
+
+    def _read_sector(self, n: int, buf: memoryview):
+        """Synthesizes a single sector."""
+        ss = self.sector_size
+        if n < self.fat_start:
+            buf[:] = self.boot
+        elif n < self.root_start:
+            i = (n - self.fat_start) % self.fat_sectors
+            buf[:] = self.fat[i * ss:(i + 1) * ss]
+        elif n < self.data_start:
+            i = n - self.root_start
+            buf[:] = self.root.data[i * ss:(i + 1) * ss]
+        else:
+            cluster, i = divmod(n - self.data_start, self.sectors_per_cluster)
+            cluster += 2
+            k = bisect_right(self._starts, cluster) - 1
+            e = self._owners[k] if k >= 0 else None
+            if e is None or cluster >= e.cluster + e.n_clusters:
+                buf[:] = bytes(ss)
+                return
+            offset = (cluster - e.cluster) * self.cluster_size + i * ss
+            if e.is_dir:
+                buf[:] = e.data[offset:offset + ss]
+            elif isinstance(e.source, bytes):
+                chunk = e.source[offset:offset + ss]
+                buf[:len(chunk)] = chunk
+                buf[len(chunk):] = bytes(ss - len(chunk))
+            else:
+                f = self._open(e.source)
+                f.seek(offset)
+                n_read = f.readinto(buf)
+                buf[n_read:] = bytes(ss - n_read)
+
+    def _open(self, path: Path):
+        """Opens a host file keeping a few recently used ones open."""
+        if path in self._files:
+            self._files.move_to_end(path)
+            return self._files[path]
+        if len(self._files) >= _MAX_OPEN_FILES:
+            self._files.popitem(last=False)[1].close()
+        f = self._files[path] = open(path, "rb")
+        return f
+
+    def close(self):
+        """Closes host files."""
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def _check_bounds(self, offset: int, length: int):
+        if offset < 0 or offset + length > self.size:
+            raise ValueError(f"out of bounds: {offset=} {length=} {self.size=}")
+
+    def readinto(self, offset: int, buf):
+        """Reads the image into the buffer."""
+        self._check_bounds(offset, len(buf))
+        ss = self.sector_size
+        buf = memoryview(buf)
+        sector = bytearray(ss)
+        pos = 0
+        while pos < len(buf):
+            n, shift = divmod(offset + pos, ss)
+            chunk = min(ss - shift, len(buf) - pos)
+            if n in self.overlay:
+                buf[pos:pos + chunk] = self.overlay[n][shift:shift + chunk]
+            elif shift == 0 and chunk == ss:
+                self._read_sector(n, buf[pos:pos + ss])
+            else:
+                self._read_sector(n, memoryview(sector))
+                buf[pos:pos + chunk] = sector[shift:shift + chunk]
+            pos += chunk
+        return len(buf)
+
+    def read(self, offset: int, length: int) -> bytearray:
+        result = bytearray(length)
+        self.readinto(offset, result)
+        return result
+
+    def write(self, offset: int, buf):
+        """Writes the buffer into the in-memory overlay."""
+        self._check_bounds(offset, len(buf))
+        ss = self.sector_size
+        buf = memoryview(buf)
+        pos = 0
+        while pos < len(buf):
+            n, shift = divmod(offset + pos, ss)
+            chunk = min(ss - shift, len(buf) - pos)
+            if n not in self.overlay:
+                sector = self.overlay[n] = bytearray(ss)
+                if chunk != ss:
+                    self._read_sector(n, memoryview(sector))
+            self.overlay[n][shift:shift + chunk] = buf[pos:pos + chunk]
+            self.dirty.add(n)
+            pos += chunk
+